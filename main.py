@@ -1,11 +1,23 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
 import time
 import os
+import asyncio
+import contextlib
+import functools
+import hashlib
+import threading
+from http import HTTPStatus
+from datetime import date
 import plotly.express as px
+import diskcache
 from dune_client.client import DuneClient
 from dune_client.query import QueryBase
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- 0. Page Configuration ---
 st.set_page_config(
@@ -25,11 +37,47 @@ if not DUNE_API_KEY:
 else:
     dune_client = DuneClient(DUNE_API_KEY)
 
+# Dune results are also persisted here so a restart doesn't re-run the queries
+DUNE_CACHE_DIR = os.environ.get("DUNE_CACHE_DIR", "/tmp/dune_cache")
+
 # --- 2. Define SQL Queries and Query IDs ---
+# Marks a query ID that is set but not a number; that Dune fetch is skipped
+INVALID_QUERY_ID = object()
+
+def _parse_id(env_var):
+    """
+    Reads a Dune query ID from the environment. Returns None if unset and
+    INVALID_QUERY_ID if it is not a number.
+    """
+    raw = os.environ.get(env_var)
+    if not raw:
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        st.error(f"Invalid {env_var}: {raw}. Must be a number.")
+        return INVALID_QUERY_ID
+
 # Option 1: Use query IDs (works with free tier)
 # Create queries manually in Dune Analytics UI and paste the query IDs here
-ARBITRUM_QUERY_ID = os.environ.get("ARBITRUM_QUERY_ID")  # Set this in environment variables
-OPTIMISM_QUERY_ID = os.environ.get("OPTIMISM_QUERY_ID")  # Set this in environment variables
+ARBITRUM_QUERY_ID = _parse_id("ARBITRUM_QUERY_ID")  # Set this in environment variables
+OPTIMISM_QUERY_ID = _parse_id("OPTIMISM_QUERY_ID")  # Set this in environment variables
+# Or a single query covering both chains (see L2_SQL_QUERY); takes precedence
+# over the per-chain IDs and halves the Dune executions
+L2_QUERY_ID = _parse_id("L2_QUERY_ID")  # Set this in environment variables
+# An invalid L2_QUERY_ID has already been reported; fall back to the per-chain path
+USE_L2_QUERY = L2_QUERY_ID not in (None, INVALID_QUERY_ID)
+
+class DunePaidPlanRequired(Exception):
+    """
+    Raised when Dune rejects a request with HTTP 402 (raw SQL needs a paid plan).
+    """
+
+# Columns returned by the per-chain queries below
+DUNE_COLS = ('date', 'daily_active_users', 'transaction_count', 'avg_gas_fee_usd')
+# Columns left once 'date' becomes the index
+DUNE_METRIC_COLS = DUNE_COLS[1:]
+TVL_COLS = ('tvl_usd',)
 
 # Option 2: Raw SQL queries (requires paid plan)
 ARBITRUM_SQL_QUERY = """
@@ -62,51 +110,189 @@ GROUP BY 1
 ORDER BY 1 DESC
 """
 
+# Both chains in one query, tagged with a chain column. Create it in the Dune
+# UI and set L2_QUERY_ID to load both chains with a single execution
+L2_SQL_QUERY = """
+SELECT
+    'arbitrum' AS chain,
+    DATE_TRUNC('day', block_time) AS date,
+    COUNT(DISTINCT "from") AS daily_active_users,
+    COUNT(hash) AS transaction_count,
+    SUM(gas_used * gas_price / 1e18 * p.price) / COUNT(hash) AS avg_gas_fee_usd
+FROM arbitrum.transactions t
+LEFT JOIN prices.usd p ON p.minute = DATE_TRUNC('minute', t.block_time)
+    AND p.symbol = 'ETH'
+WHERE
+    t.block_time >= NOW() - INTERVAL '90' DAY -- Look back 90 days
+GROUP BY 1, 2
+UNION ALL
+SELECT
+    'optimism' AS chain,
+    DATE_TRUNC('day', block_time) AS date,
+    COUNT(DISTINCT "from") AS daily_active_users,
+    COUNT(hash) AS transaction_count,
+    SUM(gas_used * gas_price / 1e18 * p.price) / COUNT(hash) AS avg_gas_fee_usd
+FROM optimism.transactions t
+LEFT JOIN prices.usd p ON p.minute = DATE_TRUNC('minute', t.block_time)
+    AND p.symbol = 'ETH'
+WHERE
+    t.block_time >= NOW() - INTERVAL '90' DAY -- Look back 90 days
+GROUP BY 1, 2
+ORDER BY 2 DESC
+"""
+
 # --- 3. Cached Data Fetching Functions ---
 
-@st.cache_data(ttl=3600)  # Cache for 1 hour (3600 seconds)
+def _index_by_date(df, dates):
+    """
+    Replaces the 'date' column with a daily datetime64 index (naive UTC) so
+    DefiLlama and Dune frames align on the same keys.
+    """
+    index = pd.DatetimeIndex(dates, name='date')
+    if index.tz is not None:
+        index = index.tz_convert(None)
+    return df.drop(columns='date').set_index(index.normalize())
+
+def _empty_frame(columns):
+    """
+    Empty frame with the same 'date' index as the success path, for fallbacks.
+    """
+    return pd.DataFrame(columns=list(columns), index=pd.DatetimeIndex([], name='date'))
+
+def _shrink(df):
+    """
+    Downcasts 64-bit numeric columns to the smallest dtype that holds them,
+    then moves the frame to Arrow-backed dtypes so Streamlit can hand it to
+    its Arrow serializer without converting.
+    """
+    for col in df.select_dtypes('int64'):
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    for col in df.select_dtypes('float64'):
+        df[col] = pd.to_numeric(df[col], downcast='float')
+    return df.convert_dtypes(dtype_backend='pyarrow')
+
+@st.cache_resource
+def _http():
+    """
+    Shared HTTP session so DefiLlama calls reuse pooled keep-alive connections.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def _disk_cache():
+    """
+    SQLite-backed cache shared by all sessions; survives container restarts.
+    """
+    return diskcache.Cache(DUNE_CACHE_DIR)
+
+def _persist_to_disk(fn):
+    """
+    Persists non-empty DataFrame results of fn on disk for up to 1 hour,
+    keyed by the call arguments and today's date.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args):
+        payload = "|".join([fn.__name__, *map(str, args), str(date.today())])
+        key = hashlib.sha256(payload.encode()).hexdigest()
+        cached = _disk_cache().get(key)
+        if cached is not None:
+            return cached
+        df = fn(*args)
+        if not df.empty:
+            _disk_cache().set(key, df, expire=3600)
+        return df
+    return wrapper
+
+@st.cache_resource
+def _cache_fill_times():
+    """
+    When each (function name, *args) cache_data entry was last filled,
+    shared across sessions so a rerun can tell whether its fetches are warm.
+    """
+    return {}
+
+def _track_cache_fill(fn):
+    """
+    Records in _cache_fill_times() when a call of fn returned, i.e. when
+    st.cache_data (applied on top) stored its value. Failed calls aren't
+    cached, so they aren't recorded.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args):
+        result = fn(*args)
+        _cache_fill_times()[(fn.__name__, *args)] = time.time()
+        return result
+    return wrapper
+
+# Fetches that missed every cache and succeeded during this run; cached
+# function bodies only execute on a miss. Streamlit re-executes the module
+# per rerun, so this starts empty each time.
+_cache_misses = []
+
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False)  # Cache for 1 hour (3600 seconds)
+@_track_cache_fill
 def fetch_defi_llama_tvl(chain_slug):
     """
-    Fetches historical TVL data from DefiLlama.
+    Fetches historical TVL data from DefiLlama. Errors propagate (and so
+    are not cached); they are shown outside the cached function.
     """
     url = f"https://api.llama.fi/charts/{chain_slug}"
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        df = pd.DataFrame(data)
-        # Fix FutureWarning by converting to numeric first
-        df['date'] = pd.to_datetime(pd.to_numeric(df['date']), unit='s').dt.date
-        df.rename(columns={'totalLiquidityUSD': 'tvl_usd'}, inplace=True)
-        return df
-    except requests.exceptions.RequestException as e:
-        # Return empty DataFrame, error will be shown outside cached function
-        return pd.DataFrame(columns=['date', 'tvl_usd'])
+    response = _http().get(url, timeout=15)
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    df = pd.DataFrame.from_records(data, columns=['date', 'totalLiquidityUSD'])
+    # DefiLlama sends epoch seconds as strings; cast straight to int64
+    df = _index_by_date(df, pd.to_datetime(df['date'].astype('int64'), unit='s'))
+    df = _shrink(df.rename(columns={'totalLiquidityUSD': 'tvl_usd'}))
+    _cache_misses.append(f"DefiLlama TVL data for {chain_slug}")
+    return df
 
-@st.cache_data(ttl=3600)  # Cache for 1 hour
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False)  # Cache for 1 hour
+@_track_cache_fill
+@_persist_to_disk
 def query_dune_api_by_id(query_id):
     """
     Executes a Dune query by ID (works with free tier).
     """
     if not dune_client:
-        return pd.DataFrame()
+        return _empty_frame(DUNE_METRIC_COLS)
     
     try:
         query = QueryBase(query_id=query_id, name="query")
-        results_df = dune_client.run_query_dataframe(query)
-        if not results_df.empty and 'date' in results_df.columns:
-            results_df['date'] = pd.to_datetime(results_df['date']).dt.date
+        # Reuse the query's last execution when it is under an hour old;
+        # dune-client re-runs (and polls) the query only when it is older
+        latest = dune_client.get_latest_result(query, max_age_hours=1)
+        if latest.result is None or not latest.result.rows:
+            # Latest execution is pending, failed, cancelled or empty:
+            # run the query and poll it until it finishes
+            results_df = dune_client.run_query_dataframe(query)
+        else:
+            # The query is user-defined, so take its schema from the result metadata
+            results_df = pd.DataFrame.from_records(
+                latest.result.rows, columns=latest.result.metadata.column_names
+            )
+        if results_df.empty:
+            results_df = _empty_frame(DUNE_METRIC_COLS)
+        elif 'date' in results_df.columns:
+            results_df = _index_by_date(results_df, pd.to_datetime(results_df['date'], utc=True))
+        results_df = _shrink(results_df)
+        _cache_misses.append(f"Dune query {query_id}")
         return results_df
     except Exception as e:
         raise Exception(f"Dune API error for query ID {query_id}: {str(e)}")
 
-@st.cache_data(ttl=3600)  # Cache for 1 hour
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False)  # Cache for 1 hour
+@_track_cache_fill
+@_persist_to_disk
 def query_dune_api_by_sql(query_name, sql_query):
     """
     Executes a SQL query using run_sql (requires paid plan).
     """
     if not dune_client:
-        return pd.DataFrame()
+        return _empty_frame(DUNE_METRIC_COLS)
         
     try:
         # Use run_sql for raw SQL queries (requires paid plan)
@@ -129,30 +315,35 @@ def query_dune_api_by_sql(query_name, sql_query):
         elif hasattr(result, 'rows'):
             rows = result.rows
         
+        _cache_misses.append(f"Dune SQL query for {query_name}")
         if rows:
-            results_df = pd.DataFrame(rows)
+            results_df = pd.DataFrame.from_records(rows, columns=DUNE_COLS)
             if not results_df.empty and 'date' in results_df.columns:
-                results_df['date'] = pd.to_datetime(results_df['date']).dt.date
-            return results_df
+                results_df = _index_by_date(results_df, pd.to_datetime(results_df['date'], utc=True))
+            return _shrink(results_df)
         else:
-            return pd.DataFrame()
+            return _empty_frame(DUNE_METRIC_COLS)
             
     except Exception as e:
-        error_msg = str(e)
-        if "paid plan" in error_msg.lower() or "upgrade" in error_msg.lower():
-            raise Exception(
+        # dune-client surfaces API errors as the underlying requests HTTPError
+        if (
+            isinstance(e, requests.exceptions.HTTPError)
+            and e.response is not None
+            and e.response.status_code == HTTPStatus.PAYMENT_REQUIRED
+        ):
+            raise DunePaidPlanRequired(
                 f"Dune API requires a paid plan to create queries programmatically. "
                 f"Please create queries manually in Dune Analytics UI and use query IDs instead. "
-                f"Set ARBITRUM_QUERY_ID and OPTIMISM_QUERY_ID environment variables."
-            )
-        raise Exception(f"Dune API error for {query_name}: {error_msg}")
+                f"Set ARBITRUM_QUERY_ID and OPTIMISM_QUERY_ID (or a combined L2_QUERY_ID) environment variables."
+            ) from e
+        raise Exception(f"Dune API error for {query_name}: {e}") from e
 
 # --- 4. Main Dashboard UI ---
 
 st.title("L2 Showdown: Arbitrum vs. Optimism")
 
 # --- Setup Instructions (if query IDs not set) ---
-if not ARBITRUM_QUERY_ID or not OPTIMISM_QUERY_ID:
+if not USE_L2_QUERY and (ARBITRUM_QUERY_ID is None or OPTIMISM_QUERY_ID is None):
     with st.expander("ℹ️ Dune API Setup Instructions (Free Tier)", expanded=False):
         st.info("""
         **To use Dune API with a free account:**
@@ -166,79 +357,214 @@ if not ARBITRUM_QUERY_ID or not OPTIMISM_QUERY_ID:
            - `ARBITRUM_QUERY_ID=your_arbitrum_query_id`
            - `OPTIMISM_QUERY_ID=your_optimism_query_id`
         
+        **Single query:** Create one query from the combined SQL in the code (`L2_SQL_QUERY`) and set `L2_QUERY_ID` instead. Both chains then load with one Dune execution.
+        
         **Alternative:** If you have a paid Dune plan, the app will automatically use raw SQL queries.
         """)
 
 # --- Load Data ---
-with st.spinner("Loading all chain data... This may take a moment on first load."):
-    st.toast("Fetching DefiLlama TVL data for arbitrum...")
-    arbitrum_tvl_df = fetch_defi_llama_tvl('arbitrum')
-    if arbitrum_tvl_df.empty:
-        st.error("Error fetching Arbitrum TVL data from DefiLlama")
-    
-    st.toast("Fetching DefiLlama TVL data for optimism...")
-    optimism_tvl_df = fetch_defi_llama_tvl('optimism')
-    if optimism_tvl_df.empty:
-        st.error("Error fetching Optimism TVL data from DefiLlama")
-    
-    st.toast("Executing Dune query for arbitrum...")
-    arbitrum_dune_df = pd.DataFrame()
-    try:
-        # Try using query ID first (works with free tier)
-        if ARBITRUM_QUERY_ID:
-            try:
-                arbitrum_dune_df = query_dune_api_by_id(int(ARBITRUM_QUERY_ID))
-            except ValueError:
-                st.error(f"Invalid ARBITRUM_QUERY_ID: {ARBITRUM_QUERY_ID}. Must be a number.")
-        else:
-            # Fall back to SQL query (requires paid plan)
-            st.warning("⚠️ ARBITRUM_QUERY_ID not set. Attempting to use raw SQL (requires paid Dune plan)...")
-            try:
-                arbitrum_dune_df = query_dune_api_by_sql('arbitrum', ARBITRUM_SQL_QUERY)
-            except Exception as sql_error:
-                if "paid plan" in str(sql_error).lower():
-                    st.error("❌ Dune API requires a paid plan for raw SQL queries. Please set ARBITRUM_QUERY_ID environment variable. See setup instructions above.")
-                else:
-                    raise
-        
-        if arbitrum_dune_df.empty:
-            st.warning("Arbitrum Dune query returned no data. This may be normal if the query is still executing.")
-    except Exception as e:
-        st.error(f"Error querying Dune API for arbitrum: {e}")
-        arbitrum_dune_df = pd.DataFrame()
-    
-    st.toast("Executing Dune query for optimism...")
-    optimism_dune_df = pd.DataFrame()
-    try:
-        # Try using query ID first (works with free tier)
-        if OPTIMISM_QUERY_ID:
-            try:
-                optimism_dune_df = query_dune_api_by_id(int(OPTIMISM_QUERY_ID))
-            except ValueError:
-                st.error(f"Invalid OPTIMISM_QUERY_ID: {OPTIMISM_QUERY_ID}. Must be a number.")
+def _call_with_script_ctx(ctx, fn):
+    """
+    Runs fn in a worker thread attached to the current Streamlit script run,
+    so cached functions behave as they do on the main thread.
+    """
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return fn()
+
+# Max concurrent requests per upstream, to stay clear of rate limits (HTTP 429)
+DEFILLAMA_CONCURRENCY = 4
+DUNE_CONCURRENCY = 2
+
+async def load_all(*dune_calls):
+    """
+    Runs the DefiLlama and Dune fetches concurrently. The fetchers are sync
+    (requests / dune-client behind st.cache_data), so each one gets its own
+    executor thread, bounded by a per-host semaphore. Returns the Arbitrum
+    and Optimism TVL frames followed by one result per Dune call (an empty
+    frame for a skipped call of None); exceptions are returned rather than
+    raised.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = get_script_run_ctx()
+    # Created per run: asyncio.run() starts a fresh event loop on every rerun
+    defillama_sem = asyncio.Semaphore(DEFILLAMA_CONCURRENCY)
+    dune_sem = asyncio.Semaphore(DUNE_CONCURRENCY)
+
+    async def run(sem, fn):
+        if fn is None:
+            return _empty_frame(DUNE_METRIC_COLS)
+        async with sem:
+            return await loop.run_in_executor(None, _call_with_script_ctx, ctx, fn)
+
+    return await asyncio.gather(
+        run(defillama_sem, functools.partial(fetch_defi_llama_tvl, 'arbitrum')),
+        run(defillama_sem, functools.partial(fetch_defi_llama_tvl, 'optimism')),
+        *(run(dune_sem, call) for call in dune_calls),
+        return_exceptions=True,
+    )
+
+def _dune_call(chain, query_id, sql_query):
+    """
+    Picks the Dune fetch for a chain: query ID first (works with free tier),
+    falling back to raw SQL (requires paid plan). Returns None for an
+    invalid ID, which was already reported, so that chain is skipped.
+    """
+    if query_id is INVALID_QUERY_ID:
+        return None
+    if query_id is not None:
+        return functools.partial(query_dune_api_by_id, query_id)
+    st.warning(f"⚠️ {chain.upper()}_QUERY_ID not set. Attempting to use raw SQL (requires paid Dune plan)...")
+    return functools.partial(query_dune_api_by_sql, chain, sql_query)
+
+def _load_tvl(name, result):
+    """
+    Reports the outcome of a DefiLlama fetch and returns its DataFrame
+    (empty on error).
+    """
+    if isinstance(result, Exception):
+        st.error(f"Error fetching {name} TVL data from DefiLlama: {result}")
+        return _empty_frame(TVL_COLS)
+    if result.empty:
+        st.error(f"Error fetching {name} TVL data from DefiLlama")
+    return result
+
+def _load_dune(name, result, id_var):
+    """
+    Reports the outcome of a Dune fetch and returns its DataFrame
+    (empty on error). name labels the query in messages; id_var is the
+    environment variable that selects it.
+    """
+    if isinstance(result, Exception):
+        if isinstance(result, DunePaidPlanRequired):
+            st.error(f"❌ Dune API requires a paid plan for raw SQL queries. Please set {id_var} (or a combined L2_QUERY_ID) environment variable. See setup instructions above.")
         else:
-            # Fall back to SQL query (requires paid plan)
-            st.warning("⚠️ OPTIMISM_QUERY_ID not set. Attempting to use raw SQL (requires paid Dune plan)...")
-            try:
-                optimism_dune_df = query_dune_api_by_sql('optimism', OPTIMISM_SQL_QUERY)
-            except Exception as sql_error:
-                if "paid plan" in str(sql_error).lower():
-                    st.error("❌ Dune API requires a paid plan for raw SQL queries. Please set OPTIMISM_QUERY_ID environment variable. See setup instructions above.")
-                else:
-                    raise
-        
-        if optimism_dune_df.empty:
-            st.warning("Optimism Dune query returned no data. This may be normal if the query is still executing.")
-    except Exception as e:
-        st.error(f"Error querying Dune API for optimism: {e}")
-        optimism_dune_df = pd.DataFrame()
+            st.error(f"Error querying Dune API for {name}: {result}")
+        return _empty_frame(DUNE_METRIC_COLS)
+    if result.empty:
+        st.warning(f"{name} Dune query returned no data. This may be normal if the query is still executing.")
+    return result
+
+def _split_by_chain(combined_df):
+    """
+    Splits the combined L2 query result into (arbitrum, optimism) frames,
+    warning about a missing 'chain' column or chain.
+    """
+    if combined_df.empty:
+        # Already reported by _load_dune
+        return _empty_frame(DUNE_METRIC_COLS), _empty_frame(DUNE_METRIC_COLS)
+    if 'chain' not in combined_df.columns:
+        st.warning("Combined L2 Dune query has no 'chain' column. Check that L2_QUERY_ID points at the combined query (see L2_SQL_QUERY).")
+        return _empty_frame(DUNE_METRIC_COLS), _empty_frame(DUNE_METRIC_COLS)
+    by_chain = {
+        chain: chain_df.drop(columns='chain')
+        for chain, chain_df in combined_df.groupby('chain', observed=True)
+    }
+    for chain in ('arbitrum', 'optimism'):
+        if chain not in by_chain:
+            st.warning(f"Combined L2 Dune query returned no rows for chain '{chain}'.")
+    return by_chain.get('arbitrum', _empty_frame(DUNE_METRIC_COLS)), by_chain.get('optimism', _empty_frame(DUNE_METRIC_COLS))
+
+if USE_L2_QUERY:
+    dune_calls = [functools.partial(query_dune_api_by_id, L2_QUERY_ID)]
+else:
+    dune_calls = [
+        _dune_call('arbitrum', ARBITRUM_QUERY_ID, ARBITRUM_SQL_QUERY),
+        _dune_call('optimism', OPTIMISM_QUERY_ID, OPTIMISM_SQL_QUERY),
+    ]
+
+# Skip the spinner when every cache entry this run needs was filled within
+# the TTL, i.e. the load will be all cache hits
+cache_keys = [(fetch_defi_llama_tvl.__name__, chain) for chain in ('arbitrum', 'optimism')]
+cache_keys += [(call.func.__name__, *call.args) for call in dune_calls if call is not None]
+fill_times = _cache_fill_times()
+caches_warm = all(time.time() - fill_times.get(key, 0) < 3600 for key in cache_keys)
+loading = contextlib.nullcontext() if caches_warm else st.spinner(
+    "Loading all chain data... This may take a moment on first load."
+)
+
+with loading:
+    arbitrum_tvl_df, optimism_tvl_df, *dune_results = asyncio.run(load_all(*dune_calls))
+
+    # Only announce fetches that actually went to the network
+    for fetched in _cache_misses:
+        st.toast(f"Fetched {fetched}")
+
+    arbitrum_tvl_df = _load_tvl('Arbitrum', arbitrum_tvl_df)
+    optimism_tvl_df = _load_tvl('Optimism', optimism_tvl_df)
+
+    if USE_L2_QUERY:
+        arbitrum_dune_df, optimism_dune_df = _split_by_chain(
+            _load_dune('Combined L2', dune_results[0], 'L2_QUERY_ID')
+        )
+    else:
+        arbitrum_dune_df = _load_dune('Arbitrum', dune_results[0], 'ARBITRUM_QUERY_ID')
+        optimism_dune_df = _load_dune('Optimism', dune_results[1], 'OPTIMISM_QUERY_ID')
 
 # --- Merge Data ---
-@st.cache_data
+MERGED_COLUMNS = ['tvl_usd', 'daily_active_users', 'transaction_count', 'avg_gas_fee_usd']
+
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False)  # Cache for 1 hour
 def merge_data(tvl_df, dune_df):
+    """
+    Inner-joins TVL and Dune metrics on their date index. If either side is
+    empty, returns an empty frame with the merged schema without joining.
+    """
     if tvl_df.empty or dune_df.empty:
-        return pd.DataFrame()
-    return pd.merge(tvl_df, dune_df, on='date', how='inner')
+        return _empty_frame(MERGED_COLUMNS)
+    return tvl_df.join(dune_df, how='inner')
+
+def to_long_format(arbitrum_df, optimism_df):
+    """
+    Stacks both chains into one long frame (date, chain, variable, value)
+    so each chart is a single px.line colored by chain.
+    """
+    # Plotly wants plain floats; melting mixed Arrow dtypes would give object
+    return pd.concat([
+        arbitrum_df[MERGED_COLUMNS].astype('float64').assign(chain='Arbitrum'),
+        optimism_df[MERGED_COLUMNS].astype('float64').assign(chain='Optimism'),
+    ]).reset_index().melt(
+        id_vars=['date', 'chain'],
+        value_vars=MERGED_COLUMNS,
+    )
+
+def metric_chart(long_df, metric, title):
+    """
+    Line chart of one metric from the long frame, one line per chain.
+    """
+    return px.line(
+        long_df[long_df['variable'] == metric],
+        x='date', y='value', color='chain', title=title,
+        labels={'date': '', 'value': '', 'chain': ''},
+    )
+
+def frame_hash(df):
+    """
+    Cheap scalar fingerprint of a DataFrame's contents, used as a cache key.
+    """
+    return int(pd.util.hash_pandas_object(df, index=True).sum())
+
+@st.cache_resource(max_entries=4)
+def build_figs(arbitrum_hash, optimism_hash, _arbitrum_df, _optimism_df):
+    """
+    Builds the four comparison charts. Keyed only on the frame hashes;
+    the underscored frames are not hashed by Streamlit.
+    """
+    long_df = to_long_format(_arbitrum_df, _optimism_df)
+    return {
+        'tvl': metric_chart(long_df, 'tvl_usd', "TVL (USD) Over Time"),
+        'dau': metric_chart(long_df, 'daily_active_users', "Daily Active Users Over Time"),
+        'tx': metric_chart(long_df, 'transaction_count', "Daily Transactions Over Time"),
+        'gas': metric_chart(long_df, 'avg_gas_fee_usd', "Average Gas Fee (USD) Over Time"),
+    }
+
+def pairwise_corr(df, col_a, col_b):
+    """
+    Pearson correlation of two columns over rows where both are present.
+    """
+    a = df[col_a].to_numpy(dtype=float, na_value=np.nan)
+    b = df[col_b].to_numpy(dtype=float, na_value=np.nan)
+    mask = ~(np.isnan(a) | np.isnan(b))
+    return np.corrcoef(a[mask], b[mask])[0, 1]
 
 arbitrum_full_df = merge_data(arbitrum_tvl_df, arbitrum_dune_df)
 optimism_full_df = merge_data(optimism_tvl_df, optimism_dune_df)
@@ -254,8 +580,9 @@ else:
     col1, col2, col3, col4 = st.columns(4)
     
     # Get latest row
-    arb_latest = arbitrum_full_df.iloc[-1]
-    op_latest = optimism_full_df.iloc[-1]
+    # tail(1) keeps each column's dtype; iloc[-1] would upcast the row to float
+    arb_latest = arbitrum_full_df.tail(1).to_dict('records')[0]
+    op_latest = optimism_full_df.tail(1).to_dict('records')[0]
 
     col1.metric("Arbitrum TVL", f"${arb_latest['tvl_usd']/1e9:.2f}B")
     col2.metric("Optimism TVL", f"${op_latest['tvl_usd']/1e9:.2f}B")
@@ -264,44 +591,36 @@ else:
 
     # --- Visualizations ---
     st.header("Comparative Analysis")
+    figs = build_figs(
+        frame_hash(arbitrum_full_df), frame_hash(optimism_full_df),
+        arbitrum_full_df, optimism_full_df,
+    )
 
     col1, col2 = st.columns(2)
 
     with col1:
         st.subheader("Total Value Locked (TVL)")
-        fig_tvl = px.line(title="TVL (USD) Over Time")
-        fig_tvl.add_scatter(x=arbitrum_full_df['date'], y=arbitrum_full_df['tvl_usd'], name="Arbitrum")
-        fig_tvl.add_scatter(x=optimism_full_df['date'], y=optimism_full_df['tvl_usd'], name="Optimism")
-        st.plotly_chart(fig_tvl, use_container_width=True)
+        st.plotly_chart(figs['tvl'], use_container_width=True)
 
     with col2:
         st.subheader("Daily Active Users (DAU)")
-        fig_dau = px.line(title="Daily Active Users Over Time")
-        fig_dau.add_scatter(x=arbitrum_full_df['date'], y=arbitrum_full_df['daily_active_users'], name="Arbitrum")
-        fig_dau.add_scatter(x=optimism_full_df['date'], y=optimism_full_df['daily_active_users'], name="Optimism")
-        st.plotly_chart(fig_dau, use_container_width=True)
+        st.plotly_chart(figs['dau'], use_container_width=True)
 
     col3, col4 = st.columns(2)
 
     with col3:
         st.subheader("Transaction Count")
-        fig_tx = px.line(title="Daily Transactions Over Time")
-        fig_tx.add_scatter(x=arbitrum_full_df['date'], y=arbitrum_full_df['transaction_count'], name="Arbitrum")
-        fig_tx.add_scatter(x=optimism_full_df['date'], y=optimism_full_df['transaction_count'], name="Optimism")
-        st.plotly_chart(fig_tx, use_container_width=True)
+        st.plotly_chart(figs['tx'], use_container_width=True)
 
     with col4:
         st.subheader("Average Gas Fee (USD)")
-        fig_gas = px.line(title="Average Gas Fee (USD) Over Time")
-        fig_gas.add_scatter(x=arbitrum_full_df['date'], y=arbitrum_full_df['avg_gas_fee_usd'], name="Arbitrum")
-        fig_gas.add_scatter(x=optimism_full_df['date'], y=optimism_full_df['avg_gas_fee_usd'], name="Optimism")
-        st.plotly_chart(fig_gas, use_container_width=True)
+        st.plotly_chart(figs['gas'], use_container_width=True)
 
     # --- Correlation Analysis ---
     st.header("Correlation Analysis")
     try:
-        arb_gas_corr = arbitrum_full_df['avg_gas_fee_usd'].corr(arbitrum_full_df['transaction_count'])
-        op_gas_corr = optimism_full_df['avg_gas_fee_usd'].corr(optimism_full_df['transaction_count'])
+        arb_gas_corr = pairwise_corr(arbitrum_full_df, 'avg_gas_fee_usd', 'transaction_count')
+        op_gas_corr = pairwise_corr(optimism_full_df, 'avg_gas_fee_usd', 'transaction_count')
         
         col1, col2 = st.columns(2)
         col1.metric("Arbitrum: Gas Fee vs. Tx Count Corr.", f"{arb_gas_corr:.2f}")
@@ -314,4 +633,4 @@ else:
         st.subheader("Arbitrum Raw Data")
         st.dataframe(arbitrum_full_df.tail())
         st.subheader("Optimism Raw Data")
-        st.dataframe(optimism_full_df.tail())
\ No newline at end of file
+        st.dataframe(optimism_full_df.tail())